@@ -17,9 +17,9 @@ has priority over less deep paths.
 of <root> named after <root> and the current datetime.
 
 Usage:    
-    backupy build [<root> -i <dir>... -e <dir>... --show=<MB> --filemax=<MB> --dp=<depth>]
+    backupy build [<root> -i <dir>... -e <dir>... --show=<MB> --filemax=<MB> --dp=<depth> --follow-symlinks]
     backupy reset [<root>]
-    backupy zip [<root>]
+    backupy zip [<root> --compression=<method> --level=<n> --follow-symlinks]
     backupy -h|--help
 
 Arguments:
@@ -41,26 +41,61 @@ Options:
                     A negative value disables the option [default: -1]
     --dp=<depth>    Max. recursion depth for editing backup paths. A negative
                     value doesn't limit the recursion depth [default: -1]
+    --compression=<method>
+                    Compression of the archive, one of "stored", "deflated",
+                    "bzip2", "lzma" or "lzma2-mt". "lzma2-mt" creates a
+                    7z-archive instead, using the external 7-Zip executable
+                    `7zz` with all CPU cores [default: deflated]
+    --level=<n>     Compression level, e.g. 0-9 for "deflated". Defaults
+                    to the default level of the compression method
+    --follow-symlinks
+                    Back up the contents of symbolically linked directories.
+                    Without it they are stored as empty directories. The
+                    setting of "build" is saved in the config file and
+                    used by "zip" as well
 """
+import bisect
+import collections
 import csv
 import datetime
+import heapq
 import logging
 import math
-import numpy as np
+import multiprocessing
 import os, sys
+import queue
+import shutil
+import subprocess
+import tempfile
+import time
+import zipfile
+import zlib
 
+from array import array
 from colorama import Fore, Back, Style
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from docopt import docopt
 from pathlib import Path
-from zipfile import ZipFile, ZIP_LZMA
+from zipfile import ZipFile, ZipInfo
+from zipfile import ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA
 
 # Definition of globals and classes
-__all__ = ["Backup", "BackupPath", "BackupPathStructure"]
+__all__ = ["Backup", "BackupPath", "BackupPathStructure", "Entry", "TreeStats"]
 __version__ = '0.1'
 __doc__ = __doc__.format(version=__version__)
 
 BACKUPY_CFG = ".backupy.cfg"  # suffix for configuration file
 BACKUPY_LOG = ".backupy.log"  # suffix for log file
+IO_BUFSIZE = 1 << 20  # size of the buffer for reading files into an archive
+
+LZMA2_MT = "lzma2-mt"  # multi-threaded LZMA2 via 7-Zip, creates a 7z-archive
+SEVENZIP = "7zz"  # 7-Zip executable used for LZMA2_MT
+COMPRESSION_METHODS = {"stored": ZIP_STORED,
+                       "deflated": ZIP_DEFLATED,
+                       "bzip2": ZIP_BZIP2,
+                       "lzma": ZIP_LZMA,
+                       LZMA2_MT: LZMA2_MT}
 
 
 def print_size(size, split=False, digits=1, fixedwidth=True):
@@ -100,9 +135,50 @@ def print_size(size, split=False, digits=1, fixedwidth=True):
     #val2 = round(x, -int(math.floor(math.log10(abs(x)))))
 
 
+SIZE_DIVISORS = (1, 1E3, 1E6, 1E9, 1E12, 1E15)
+SIZE_SUFFIXES = ("B", "K", "M", "G", "T", "P")
+
+
+def print_sizes(sizes, digits=1):
+    """`print_size` with `fixedwidth=True` for a sequence of size values,
+    with the format strings built only once. Return list of strings
+    """
+    formats = ["{:3.0f}" + " " * (digits + 1) + " B"]
+    formats += [f"{{:{digits + 4:d}.{digits:d}f}} {suffix}"
+                for suffix in SIZE_SUFFIXES[1:]]
+    thresholds = SIZE_DIVISORS[1:]
+    result = []
+    for size in sizes:
+        i = bisect.bisect_right(thresholds, size)
+        result.append(formats[i].format(size / SIZE_DIVISORS[i]))
+    return result
+
+
 def get_n_digits(number):
     """Without floating point part"""
-    return int(math.floor(math.log10(abs(number)))) + 1
+    return len(str(int(abs(number))))
+
+
+def quantile(values, q):
+    """Same as `numpy.quantile(values, q)` with linear interpolation, but
+    only the items above the quantile are sorted (by `heapq.nlargest`),
+    which is cheap for `q` close to 1
+    """
+    pos = (len(values) - 1) * q
+    lo = int(math.floor(pos))
+    top = heapq.nlargest(len(values) - lo, values)  # values[lo:] descending
+    v_lo = top[-1]
+    v_hi = top[-2] if len(top) > 1 else v_lo
+    return float(v_lo + (v_hi - v_lo) * (pos - lo))
+
+
+def nth_largest(values, n):
+    """Return the `n`-th largest item of `values` by keeping a heap of the
+    `n` largest ones, or None if it has less than `n` items
+    """
+    if len(values) < n:
+        return None
+    return int(heapq.nlargest(n, values)[-1])
 
 
 def get_filename_backupy(root):
@@ -118,6 +194,24 @@ def get_filename_log(root):
     """
     return os.path.normpath(os.path.join(root, BACKUPY_LOG))
 
+
+@dataclass
+class Entry:
+    """Metadata of a directory entry, read once while listing its parent"""
+    path: str
+    is_dir: bool
+    size: int  # 0 for directories
+    is_link: bool = False
+    mtime: float = 0.0  # st_mtime, only for files
+    mode: int = 0  # st_mode, only for files
+
+
+@dataclass
+class TreeStats:
+    """Summary collected while creating a tree by `BackupPath.make_tree`"""
+    max_depth: int
+    sizes: array  # sizes of all files in depth-first order
+
     
 class BackupPath(object):
     """Taken from https://stackoverflow.com/a/49912639/3104974"""
@@ -125,82 +219,189 @@ class BackupPath(object):
     display_filename_prefix_last = "└─ "
     display_parent_prefix_middle = "   "
     display_parent_prefix_last = "│  "
-    def __init__(self, path, parent_path, is_last,
-                 namefilter=lambda x: True,
-                 sizefilter=lambda x: True):
-        self.path = Path(str(path))
+    scan_workers = min(8, os.cpu_count() or 1)  # threads for listing dirs
+    scan_parallel_min = 4  # min. number of dirs per level to use threads
+    def __init__(self, entry: Entry, parent_path, is_last,
+                 included=True, filemax=0):
+        self.entry = entry
+        self.path = Path(entry.path)
         self.parent = parent_path
         self.is_last = is_last
         self.is_visible = True
-        self.size = 0 if self.path.is_dir() else os.path.getsize(self.path)
-        self.n_files = 1 if path.is_file() else 0
+        self._is_dir = entry.is_dir
+        self._is_file = not entry.is_dir
+        self.size = entry.size
+        self.n_files = 1 if self._is_file else 0
         if self.parent:
             self.depth = self.parent.depth + 1
         else:
             self.depth = 0
-        self.backup = namefilter(self) and sizefilter(self)
-         
-        # update size, n_files and backup to all parents
-        prnt = self.parent
-        child = self
-        while prnt is not None:
-            prnt.size += child.size
-            prnt.n_files += 1 if child.path.is_file() else 0
-            prnt.backup |= self.backup  # if any child is backed up,
-                                        # then also the parent
-            prnt = prnt.parent
-
-    @classmethod
-    def make_namefilter(cls, include=[], exclude=[]):
-        def func(bp):
-            result = True
-            if bp.path in include:
-                result = True
-            elif bp.path in exclude:
-                result = False
-            elif bp.parent:
-                result = func(bp.parent)
-            return result
-        return func
+        self._name = self.path.name if self.depth > 0 else ""
+        self._display_suffix = os.sep if self._is_dir else ""
+        # path relative to the root, same as `str(path.relative_to(root))`
+        if self.parent is None:
+            self.arcname = "."
+        elif self.parent.parent is None:
+            self.arcname = self._name
+        else:
+            self.arcname = self.parent.arcname + os.sep + self._name
+        # tree-prefixes: one for the item itself, one for all its parents
+        self._filename_prefix = (self.display_filename_prefix_last
+                                 if is_last
+                                 else self.display_filename_prefix_middle)
+        if self.parent is None or self.parent.parent is None:
+            self._parent_prefix = ""
+        else:
+            self._parent_prefix = self.parent._parent_prefix + (
+                self.display_parent_prefix_middle
+                if self.parent.is_last
+                else self.display_parent_prefix_last)
+        self._included = included  # include / exclude policy
+        self.backup = included and (filemax <= 0 or self.size < filemax)
             
     @classmethod
-    def make_tree(cls, root, parent=None, is_last=False, dir_first=True,
-                  include=[], exclude=[], filemax=0):
-        """Entry method for creating a recursive path structure.
+    def make_tree(cls, root, dir_first=True,
+                  include=[], exclude=[], filemax=0, follow_symlinks=False):
+        """Entry method for creating the path structure below directory
+        `root`. Return tuple of the flat list of BackupPath objects in
+        depth-first order, i.e. each parent precedes its children, and the
+        TreeStats of the tree.
+        Paths not mentioned in `include` or `exclude` inherit the policy
+        of their parent.
+        Symbolic links to directories are only descended into if
+        `follow_symlinks` is True, otherwise they appear as empty directory.
         """
-        root = Path(str(root))
-        if filemax > 0:
-            sizefilter = lambda s: s.size < filemax
-        else:
-            sizefilter = lambda s: True
+        include = {os.path.normcase(p) for p in include}
+        exclude = {os.path.normcase(p) for p in exclude}
+        listings = cls._scandirs(root, dir_first, follow_symlinks)
+        n_files = sum(not entry.is_dir for children in listings.values()
+                      for entry in children)
+        sizes = array("q", [0]) * n_files
+        i_file = 0
+        max_depth = 0
 
-        backup_root = cls(root, parent, is_last,
-                          cls.make_namefilter(include, exclude),
-                          sizefilter)
-        yield backup_root
-
-        
-        sort_key = lambda s: (s.is_file() if dir_first else s.is_dir(),
-                              str(s).lower())
-        children = sorted(list(path
-                               for path in root.iterdir()),
-                          key=sort_key)
-        count = 1
-        for path in children:
-            is_last = count == len(children)
-            if path.is_dir():
-                yield from cls.make_tree(path,
-                                         parent=backup_root,
-                                         is_last=is_last,
-                                         dir_first=dir_first,
-                                         include=include,
-                                         exclude=exclude,
-                                         filemax=filemax)
+        paths = []
+        stack = [(Entry(os.fspath(root), True, 0), None, False)]
+        while stack:
+            entry, parent, is_last = stack.pop()
+            key = os.path.normcase(entry.path)
+            if key in include:
+                included = True
+            elif key in exclude:
+                included = False
             else:
-                yield cls(path, backup_root, is_last,
-                          cls.make_namefilter(include, exclude),
-                          sizefilter)
-            count += 1
+                included = parent._included if parent else True
+            bp = cls(entry, parent, is_last, included, filemax)
+            max_depth = max(max_depth, bp.depth)
+            if bp._is_file:
+                sizes[i_file] = bp.size
+                i_file += 1
+            paths.append(bp)
+            if entry.is_dir:
+                children = listings.get(entry.path, [])
+                count = len(children)
+                # reversed, so the first child is popped first
+                for child in reversed(children):
+                    stack.append((child, bp, count == len(children)))
+                    count -= 1
+
+        # update size, n_files and backup bottom-up to all parents
+        for bp in reversed(paths):
+            if bp.parent is not None:
+                bp.parent.size += bp.size
+                bp.parent.n_files += bp.n_files
+                bp.parent.backup |= bp.backup  # if any child is backed up,
+                                               # then also the parent
+        return paths, TreeStats(max_depth, sizes)
+
+    @classmethod
+    def _scandirs(cls, root, dir_first=True, follow_symlinks=False):
+        """List all directories below `root` level by level. Since the
+        traversal is bound by scandir / stat calls, which release the GIL,
+        the directories of a level are listed by a thread pool if there
+        are at least `scan_parallel_min` of them.
+        Symbolic links to directories are listed only if `follow_symlinks`
+        is True and their target (by device and inode) wasn't listed
+        already, which also prevents loops of links pointing at each other.
+        Return dict {directory: result of `_scandir`}.
+        """
+        listings = {}
+        scan = lambda d: cls._scandir(d, dir_first)
+        pending = [os.fspath(root)]
+        seen = {cls._dir_id(root)} if follow_symlinks else set()
+        with ThreadPoolExecutor(max_workers=cls.scan_workers) as pool:
+            while pending:
+                if len(pending) >= cls.scan_parallel_min:
+                    results = pool.map(scan, pending)
+                else:
+                    results = map(scan, pending)
+                subdirs = []
+                for directory, children in zip(pending, results):
+                    listings[directory] = children
+                    for c in children:
+                        if not c.is_dir or c.is_link and not follow_symlinks:
+                            continue
+                        if follow_symlinks:
+                            dir_id = cls._dir_id(c.path)
+                            if c.is_link and (dir_id is None
+                                              or dir_id in seen):
+                                continue
+                            seen.add(dir_id)
+                        subdirs.append(c.path)
+                pending = subdirs
+        return listings
+
+    @staticmethod
+    def _dir_id(path):
+        """Return (st_dev, st_ino) of directory `path` after resolving
+        symbolic links, or None if it can't be resolved
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino)
+
+    @staticmethod
+    def _scandir(root, dir_first=True):
+        """Return sorted list of Entry objects for the entries of directory
+        `root`. Uses the metadata cached by `os.scandir`, so every entry
+        costs at most one stat call. Where supported, the directory is
+        listed by a file descriptor, so like with `os.fwalk` the stat calls
+        are resolved relative to the open directory (fstatat) instead of
+        walking the full path again. Broken symbolic links are skipped.
+        """
+        children = []
+        if os.scandir in os.supports_fd:
+            fd = os.open(root, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+        else:
+            fd = None
+        try:
+            with os.scandir(root if fd is None else fd) as it:
+                for entry in it:
+                    is_dir = entry.is_dir()
+                    if is_dir:
+                        st = None
+                    else:
+                        try:
+                            st = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                    path = os.path.join(root, entry.name)
+                    if st is None:
+                        child = Entry(path, True, 0, entry.is_symlink())
+                    else:
+                        child = Entry(path, False, st.st_size,
+                                      entry.is_symlink(),
+                                      st.st_mtime, st.st_mode)
+                    children.append(child)
+        finally:
+            if fd is not None:
+                os.close(fd)
+        sort_key = lambda c: (not c.is_dir if dir_first else c.is_dir,
+                              c.path.lower())
+        children.sort(key=sort_key)
+        return children
     
     def displaysize(self, split=False):
         """String for file / directory size with fixed width of 7 characters.
@@ -211,7 +412,7 @@ class BackupPath(object):
     @property
     def displaynfiles(self):
         """String for number of files of a directory, or "" for a file"""
-        if self.path.is_dir():
+        if self._is_dir:
             return " ({} files)".format(self.n_files)
         return ""
 
@@ -219,10 +420,7 @@ class BackupPath(object):
         """String for path / file incl. size and number of files
         for a directory
         """
-        result = ""
-        result += self.path.name if self.depth > 0 else ""
-        if self.path.is_dir():
-            result += os.sep
+        result = self._name + self._display_suffix
         if basic:
             return result
         
@@ -237,22 +435,8 @@ class BackupPath(object):
             return ''
         if self.parent is None:
             return self.displayname(basic=True)
-
-        _filename_prefix = (self.display_filename_prefix_last
-                            if self.is_last
-                            else self.display_filename_prefix_middle)
-
-        parts = ['{!s}{!s}'.format(_filename_prefix,
-                                    self.displayname(basic=True))]
-
-        parent = self.parent
-        while parent and parent.parent is not None:
-            parts.append(self.display_parent_prefix_middle
-                         if parent.is_last
-                         else self.display_parent_prefix_last)
-            parent = parent.parent
-
-        return ''.join(reversed(parts))
+        return (self._parent_prefix + self._filename_prefix
+                + self._name + self._display_suffix)
     
 
 class BackupPathStructure(object):
@@ -260,15 +444,19 @@ class BackupPathStructure(object):
     """
     display_style_big_entry = Back.YELLOW + Style.DIM
     display_style_backup_all = Fore.YELLOW
+    display_style_reset = Style.RESET_ALL
     style_big_entry_quantile = 0.1
     max_display = 1000
     
     csv_delimiter = "*"
     csv_quoting = csv.QUOTE_NONE
     csv_escapechar = "?"
+    csv_lineterminator = "\r\n"  # as written by csv.writer
+    csv_follow_symlinks = "follow_symlinks="  # header field for the setting
     
     def __init__(self, root, include=[], exclude=[],
-                 show=1E6, filemax=-1, max_depth=-1, dir_first=True):
+                 show=1E6, filemax=-1, max_depth=-1, dir_first=True,
+                 follow_symlinks=False):
         """
         root: base directory 
         include, exclude: lists of directory or files that shall explicitly
@@ -282,31 +470,28 @@ class BackupPathStructure(object):
         max_depth: Entries in a deeper folder-level than this are excluded
             from display (-1 to deactivate)
         dir_first: If False, files are listed first, then directories
+        follow_symlinks: If True, the contents of symbolic links to
+            directories are included as well
         """
         self.root = Path(str(root))
         self.dir_first = dir_first
+        self.follow_symlinks = follow_symlinks
         self.include = include
         self.exclude = exclude
         self.show = show
         self.filemax = filemax
-        self.tree = BackupPath.make_tree(self.root,
-                                         include=include,
-                                         exclude=exclude,
-                                         filemax=filemax,
-                                         dir_first=dir_first)
-        self.backuppaths = []
-        self.sizedist = []
+        self.backuppaths, stats = BackupPath.make_tree(
+            self.root, include=include, exclude=exclude, filemax=filemax,
+            dir_first=dir_first, follow_symlinks=follow_symlinks)
         self.max_depth_display = max_depth
-        self.max_depth_is = 0
-        for bp in self.tree:
-            self.max_depth_is = max(self.max_depth_is, bp.depth)
-            self.backuppaths.append(bp)
-            if bp.path.is_file():
-                self.sizedist.append(bp.size)
-        self.sizedist.sort(reverse=True)
+        self.max_depth_is = stats.max_depth
+        self.sizedist = stats.sizes
         self.size_total = sum(self.sizedist)
-        self.size_highlight = np.quantile(
+        self.size_highlight = quantile(
             self.sizedist, 1 - self.style_big_entry_quantile)
+        # only items larger than this are displayed (None: all items)
+        self.size_cutoff = nth_largest(self.sizedist, self.max_display + 1)
+        self._visible, self._visible_display = self._select_visible()
 # =============================================================================
 #         # number of entries up to each depth-index
 #         self.n_entries = [sum([len(_) for _ in self.sizes[:i+1]]) \
@@ -314,6 +499,26 @@ class BackupPathStructure(object):
 #         self.max_depth = max([i if n <= self.max_entries else -1
 #                              for i, n in enumerate(self.n_entries)])
 # =============================================================================
+
+    def _select_visible(self):
+        """Return the BackupPaths that show up in the config file and the
+        subset of them that is displayed, both in tree order. Paths
+        explicitly mentioned in include / exclude always show up.
+        """
+        explicit_paths = set(self.include) | set(self.exclude)
+        visible = []
+        visible_display = []
+        for bp in self.backuppaths:
+            explicit = bp.path in explicit_paths
+            if not explicit and bp.depth > self.max_depth_display > -1:
+                continue
+            if bp.depth == 0 or bp.size > self.show or explicit:
+                visible.append(bp)
+                # only display the `max_display` largest items
+                if explicit or self.size_cutoff is None \
+                        or bp.size > self.size_cutoff:
+                    visible_display.append(bp)
+        return visible, visible_display
         
     def scan(self, sizeannotate=1E8, display=True, ansi_highlight=True):
         """Main method for scanning the structure and returning a tuple
@@ -331,88 +536,78 @@ class BackupPathStructure(object):
         sizes = []
         sizep = []
         backup = []
-        names_len_max = 0
-        for bp in self.backuppaths:
-            # directory explicitly mentioned in include/exclude always show up
-            explicit = bp.path in self.include + self.exclude
-            if not explicit and (
-                bp.depth > self.max_depth_display > -1 or \
-                    (display and len(self.sizedist) > self.max_display\
-                     and bp.size <= self.sizedist[self.max_display])
-                ):
-                # only display the `max_display` largest items
-                continue
-            _filename_prefix = (bp.display_filename_prefix_last
-                                if bp.is_last
-                                else bp.display_filename_prefix_middle)
-    
+        # local names for everything that is constant in the loop
+        if ansi_highlight:
+            big = self.display_style_big_entry
+            reset = self.display_style_reset
+        else:
+            big = reset = ""
+        size_highlight = self.size_highlight
+        size_total = self.size_total
+        for bp in (self._visible_display if display else self._visible):
             name = bp.displayname(sizeannotate, basic=False)#not display)
-            if bp.size > self.size_highlight:
-                style = self.display_style_big_entry
-            else:
-                style = ""
-            if ansi_highlight:
-                parts = ['{!s}{}{!s}{}'.format(_filename_prefix,
-                                               style, name, Style.RESET_ALL)]
-            else:
-                parts = ['{!s}{!s}'.format(_filename_prefix, name)]
-    
-            parent = bp.parent
-            while parent and parent.parent is not None:
-                parts.append(bp.display_parent_prefix_middle
-                             if parent.is_last
-                             else bp.display_parent_prefix_last)
-                parent = parent.parent
-    
-            if bp.path == self.root or bp.size > self.show or explicit:
-                names.append(''.join(reversed(parts)))
-                names_len_max = max(names_len_max, len(names[-1]))
-                names_raw.append(bp.path)
-                sizes.append(bp.displaysize())
-                sizep.append(bp.size / self.size_total)
-                backup.append(bp.backup)
+            style = big if bp.size > size_highlight else ""
+            names.append(f"{bp._parent_prefix}{bp._filename_prefix}"
+                         f"{style}{name}{reset}")
+            names_raw.append(bp.path)
+            sizes.append(bp.size)
+            sizep.append(bp.size / size_total)
+            backup.append(bp.backup)
+        names_len_max = max(map(len, names), default=0)
         if display:
             return '\n'.join(names)
+        sizes = print_sizes(sizes)
         return [names, names_raw, sizes, sizep, backup, names_len_max]
     
     @classmethod
-    def from_backup_conf(cls, root):
+    def from_backup_conf(cls, root, follow_symlinks=None):
         """Return BackupPathStructure from config file. It is expected
         that 'backupy build' was run first on the given root directory,
         otherwise an error is raised.
+        follow_symlinks: None to use the setting saved in the config file
         """
-        backup_conf = cls._read_backup_conf(root) 
-        inst = cls(root, show=0)
+        backup_conf, follow_symlinks_conf = cls._read_backup_conf(root)
+        if follow_symlinks is None:
+            follow_symlinks = follow_symlinks_conf
+        inst = cls(root, show=0, follow_symlinks=follow_symlinks)
+        # deepest config level of each path, derived from its parent's,
+        # which precedes it in `backuppaths`
+        levels = {}
         for bp in inst.backuppaths:
-            parts = bp.path.relative_to(root).parts
-            bc = backup_conf
-            backup = backup_conf["."]
-            for folder in parts:
-                if folder in bc.keys():
-                    bc = bc[folder]
-                backup = bc["."]
-            bp.backup = backup
+            if bp.parent is None:
+                bc = backup_conf
+            else:
+                bc = levels[bp.parent]
+                bc = bc.get(bp._name, bc)
+            levels[bp] = bc
+            bp.backup = bc["."]
         return inst
     
     def make_backup_conf(self):
         """Create config file on disk for the BackupPathStructure.
-        This config file may be edited manually (i.e. backup-flag changed)
+        This config file may be edited manually (i.e. backup-flag changed).
+        The rows are joined directly instead of using `csv.writer`, escaping
+        special characters in the path columns the same way as the writer
+        does for `csv_quoting=csv.QUOTE_NONE`.
         """
         fn = get_filename_backupy(self.root)
-        with open(fn, "w", encoding="utf-8", newline="\n") as csvfile:
-            wrt = csv.writer(csvfile, 
-                             delimiter=self.csv_delimiter,
-                             quoting=self.csv_quoting,
-                             escapechar=self.csv_escapechar)
-            names, names_raw, sizes, sizep, backup, lmax = \
-                self.scan(display=False, ansi_highlight=False)
-            wrt.writerow(["    size ", "  size% ", " backup ",
+        dlm, esc = self.csv_delimiter, self.csv_escapechar
+        escape = str.maketrans({c: esc + c for c in dlm + esc + '"\r\n'})
+        names, names_raw, sizes, sizep, backup, lmax = \
+            self.scan(display=False, ansi_highlight=False)
+        rows = [dlm.join(["    size ", "  size% ", " backup ",
                           f" {'path (human readable)': <{lmax}} ",
-                          " path (read from script)"])
-            for n, n2, ss, sp, b in zip(names, names_raw, sizes, sizep, backup):
-                wrt.writerow([f" {ss} ", f" {100*sp:5.1f}% ",
-                              f"      {int(b)} ",
-                              f" {n: <{lmax}} ", f" {n2}" ])
+                          " path (read from script)",
+                          f" {self.csv_follow_symlinks}"
+                          f"{int(self.follow_symlinks)}"])]
+        for n, n2, ss, sp, b in zip(names, names_raw, sizes, sizep, backup):
+            rows.append(dlm.join([f" {ss} ", f" {100*sp:5.1f}% ",
+                                  f"      {int(b)} ",
+                                  f" {n: <{lmax}} ".translate(escape),
+                                  f" {n2}".translate(escape)]))
+        with open(fn, "w", encoding="utf-8", newline="\n") as csvfile:
+            csvfile.write(self.csv_lineterminator.join(rows)
+                          + self.csv_lineterminator)
         
         
     @classmethod
@@ -425,6 +620,8 @@ class BackupPathStructure(object):
              some_folder: {".": True, ...},
              some_file: {".": False},
             }
+        Return tuple of this dict and the follow_symlinks setting saved in
+        the header (False for config files written without it).
         """
         fn = get_filename_backupy(root)
         if not os.path.exists(fn):
@@ -436,7 +633,13 @@ class BackupPathStructure(object):
                             delimiter=cls.csv_delimiter,
                             quoting=cls.csv_quoting,
                             escapechar=cls.csv_escapechar)
-            rd.__next__() # header
+            header = rd.__next__()
+            follow_symlinks = False
+            for field in header[5:]:
+                field = field.strip()
+                if field.startswith(cls.csv_follow_symlinks):
+                    follow_symlinks = bool(int(
+                        field[len(cls.csv_follow_symlinks):]))
             #rows = {Path(n2.strip()): bool(int(b)) for ss, sp, b, n, n2 in rd}
             #rows = [(Path(n2.strip()), bool(int(b))) for ss, sp, b, n, n2 in rd]
             result = {}
@@ -451,29 +654,125 @@ class BackupPathStructure(object):
                     if folder not in res.keys():
                         res[folder] = {".": backup}
                     res = res[folder]                
-        return result
+        return result, follow_symlinks
 
         
+def read_chunks(src, buf):
+    """Read the unbuffered file object `src` chunk-wise into the preallocated
+    bytearray `buf` and yield memoryviews of the filled part until EOF.
+    Each view is only valid until the next chunk is read.
+    """
+    view = memoryview(buf)
+    while True:
+        n = src.readinto(buf)
+        if not n:
+            break
+        yield view[:n]
+
+
+def zipinfo_from_entry(entry: Entry, arcname):
+    """Same as `ZipInfo.from_file(entry.path, arcname)` for a file, but
+    built from the metadata cached in `entry` instead of another stat call
+    """
+    zinfo = ZipInfo(os.fspath(arcname), time.localtime(entry.mtime)[0:6])
+    zinfo.external_attr = (entry.mode & 0xFFFF) << 16  # Unix attributes
+    zinfo.file_size = entry.size
+    return zinfo
+
+
+def compress_file(path, zinfo, buf=None):
+    """Compress file `path` in memory like `ZipFile.write` would do it for
+    the archive member `zinfo`, using its compression type and level.
+    Return tuple of the completed `ZipInfo` and the compressed bytes, which
+    can be appended to a zip archive by `Backup._write_compressed`. `buf` is
+    an optional preallocated bytearray to read the file through.
+    Module-level function, so it can be used by a `multiprocessing.Pool`.
+    """
+    if zinfo.compress_type == ZIP_LZMA:
+        # Compressed data includes an end-of-stream (EOS) marker
+        zinfo.flag_bits |= 0x02
+    compressor = zipfile._get_compressor(zinfo.compress_type,
+                                         zinfo._compresslevel)
+    if buf is None:
+        buf = bytearray(IO_BUFSIZE)
+    crc = 0
+    file_size = 0
+    data = bytearray()  # grown in place, no final join / copy
+    with open(path, "rb", buffering=0) as src:
+        for chunk in read_chunks(src, buf):
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            data += compressor.compress(chunk)
+    data += compressor.flush()
+    zinfo.CRC = crc
+    zinfo.file_size = file_size  # the file may have changed since scanning
+    zinfo.compress_size = len(data)
+    return zinfo, data
+
+
+_worker_buf = None  # read buffer of a pool worker process
+
+
+def _init_worker():
+    global _worker_buf
+    _worker_buf = bytearray(IO_BUFSIZE)
+
+
+def _compress_file_star(args):
+    return compress_file(*args, buf=_worker_buf)
+
+
 class Backup(object):
-    def __init__(self, bps: BackupPathStructure):
+    pool_memory = 256E6  # max. file data held in memory by the pool
+    pool_pending_max = 2  # max. compressed files in memory per worker
+
+    def __init__(self, bps: BackupPathStructure, compression=ZIP_DEFLATED,
+                 compresslevel=None, processes=None):
         """Backup for given BackupPathStructure. Each BackupPath's backup-flag
         determines which files will be included in the zip archive.
+        compression: One of the zipfile constants ZIP_STORED, ZIP_DEFLATED,
+            ZIP_BZIP2, ZIP_LZMA or LZMA2_MT to create a 7z-archive with
+            multi-threaded LZMA2 compression by the external 7-Zip
+        compresslevel: Compression level as for `zipfile.ZipFile` or the 7-Zip
+            switch -mx. None means the default level (-mx9 for LZMA2_MT)
+        processes: Number of worker processes compressing the files of a
+            zip archive. None means `os.cpu_count()`. With 1 (also on a
+            single CPU) the files are compressed serially
+        Files larger than `pool_filemax` are always compressed serially by
+        the writer, so the data held in memory by the pool stays within
+        `pool_memory`.
         """
         self.root = bps.root
         self.bps = bps
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self.processes = processes
+        # effective number of worker processes
+        self._n_workers = processes or os.cpu_count() or 1
+        self._io_buf = bytearray(IO_BUFSIZE)
         self.created = datetime.datetime.now()
     
+    @property
+    def pool_filemax(self):
+        """Max. size of a file to be compressed by the pool, so that
+        `pool_pending_max` of them per worker fit into `pool_memory`
+        """
+        return self.pool_memory / (self.pool_pending_max * self._n_workers)
+
     @property
     def filename_zip(self):
         dt = self.created.strftime("%Y-%m-%d_%H%M%S")
+        ext = "7z" if self.compression == LZMA2_MT else "zip"
         return os.path.normpath(os.path.join(
-            self.root.parent, f"{self.root.name}_{dt}.zip"    
+            self.root.parent, f"{self.root.name}_{dt}.{ext}"    
         ))
         
     def backup(self):
-        """Create the zip file and a log file
+        """Create the zip file and a log file. The archive is written by a
+        background thread, which is fed by a queue while the entries are
+        logged.
         """
-        log_fn = get_filename_log(root)
+        log_fn = get_filename_log(self.root)
         logging.basicConfig(filename=log_fn,
             #encoding='utf-8',
             level=logging.INFO,
@@ -483,30 +782,52 @@ class Backup(object):
             f" creating {self.filename_zip}"
         logging.info(s)
         print(s)
-        out = ZipFile(self.filename_zip, mode="x", compression=ZIP_LZMA)
         bpaths = self.bps.backuppaths
         n_files = [0, 0]
         s_files = [0, 0]
-        for bp in bpaths:
-            path = bp.path.relative_to(self.root)
-            sz = f"({bp.displaysize()})" if bp.path.is_file() else "        "
-            if bp.backup:
-                ix = 0
-                s = f"  + {sz} {str(path)}"
-                out.write(bp.path, bp.path.relative_to(self.root))
-            else:
-                ix = 1
-                s = f"  - {sz} {str(path)}"        
-            if bp.path.is_file():
-                n_files[ix] += 1
-                s_files[ix] += os.path.getsize(bp.path)
-                logging.info(s)
-                print(s)
-        out_sz = print_size(os.path.getsize(self.filename_zip),
-                            fixedwidth=False)
+        # unbounded, so logging never blocks if the writer fails
+        members = queue.Queue()
+        # the worker processes are started before any other thread
+        pool = self._make_pool()
+        try:
+            with ThreadPoolExecutor(max_workers=1) as writer:
+                if self.compression == LZMA2_MT:
+                    archive = writer.submit(self._write_7z,
+                                            iter(members.get, None))
+                else:
+                    archive = writer.submit(self._write_zip,
+                                            iter(members.get, None), pool)
+                try:
+                    for bp in bpaths:
+                        if archive.done():
+                            # the writer stopped early, don't log any more
+                            # files as included, but raise its error now
+                            archive.result()
+                            break
+                        sz = f"({bp.displaysize()})" if bp._is_file \
+                            else "        "
+                        if bp.backup:
+                            ix = 0
+                            s = f"  + {sz} {bp.arcname}"
+                            members.put(bp)
+                        else:
+                            ix = 1
+                            s = f"  - {sz} {bp.arcname}"        
+                        if bp._is_file:
+                            n_files[ix] += 1
+                            s_files[ix] += bp.size
+                            logging.info(s)
+                            print(s)
+                finally:
+                    members.put(None)
+                out_size = archive.result()
+        finally:
+            if pool is not None:
+                pool.terminate()
+        out_sz = print_size(out_size, fixedwidth=False)
         root_sz = print_size(bpaths[0].size, fixedwidth=False)
         comp_sz = print_size(s_files[0], fixedwidth=False)
-        compr = 100 * (os.path.getsize(self.filename_zip) / s_files[0])
+        compr = 100 * (out_size / s_files[0])
         n1, n2 = sum(n_files), n_files[0]
         nd = get_n_digits(n1)
         s = "              '+': File was included   '-': File was skipped\n" +\
@@ -516,6 +837,143 @@ class Backup(object):
         logging.info(s)
         print(s)
 
+    def _make_pool(self):
+        """Return `multiprocessing.Pool` for compressing the files of a zip
+        archive, or None if they are written serially
+        """
+        if self.compression in (ZIP_STORED, LZMA2_MT) or self._n_workers == 1:
+            return None
+        return multiprocessing.Pool(self._n_workers, initializer=_init_worker)
+
+    def _write_zip(self, members, pool=None):
+        """Write the BackupPaths of the iterable `members` to the zip archive.
+        If a `pool` is given, the files are compressed in parallel by its
+        worker processes and the compressed data is appended to the archive
+        in the original order. Directories and files larger than
+        `pool_filemax` are always written directly.
+        Return the size of the archive in bytes.
+        """
+        with open(self.filename_zip, "xb") as fp:
+            with ZipFile(fp, mode="w",
+                         compression=self.compression,
+                         compresslevel=self.compresslevel) as out:
+                self._write_zip_members(out, members, pool)
+            return fp.tell()
+
+    def _write_zip_members(self, out, members, pool=None):
+        """Write the BackupPaths of the iterable `members` to the opened
+        ZipFile `out`. `members` is consumed only once, so it may be fed
+        by a queue.
+        With a `pool`, at most `pool_pending_max` files per worker are
+        submitted ahead of the writer, so the compressed data held in memory
+        stays bounded if writing the archive is slower than compressing.
+        """
+        if pool is None:
+            for bp in members:
+                self._write_member(out, bp)
+            return
+
+        n_pending_max = self.pool_pending_max * self._n_workers
+        pending = collections.deque()  # (bp, AsyncResult or None) in order
+        n_pending = 0  # number of AsyncResults in `pending`
+
+        def write_pending(n_max):
+            """Write members from the front of `pending`, until at most
+            `n_max` compressed files are in flight and the next one is not
+            finished yet
+            """
+            nonlocal n_pending
+            while pending:
+                bp, result = pending[0]
+                if result is None:
+                    self._write_member(out, bp)
+                elif n_pending > n_max or result.ready():
+                    self._write_compressed(out, *result.get())
+                    n_pending -= 1
+                else:
+                    break
+                pending.popleft()
+
+        filemax = self.pool_filemax
+        for bp in members:
+            if bp._is_file and bp.size <= filemax:
+                result = pool.apply_async(_compress_file_star,
+                                          ((bp.path, self._zipinfo(bp)),))
+                n_pending += 1
+            else:
+                result = None
+            pending.append((bp, result))
+            write_pending(n_pending_max)
+        write_pending(0)
+
+    def _zipinfo(self, bp):
+        """Return ZipInfo for the file of BackupPath `bp`, built from the
+        metadata read while scanning the tree
+        """
+        zinfo = zipinfo_from_entry(bp.entry, bp.arcname)
+        zinfo.compress_type = self.compression
+        zinfo._compresslevel = self.compresslevel
+        return zinfo
+
+    def _write_member(self, out, bp):
+        """Write BackupPath `bp` to the ZipFile `out`. File contents are
+        streamed into the archive through the reused buffer `_io_buf`
+        instead of the per-chunk bytes objects of `ZipFile.write`.
+        Zip64 is forced, because the file may have grown beyond the zip64
+        limit since its size was read while scanning.
+        """
+        if bp._is_dir:
+            out.write(bp.path, bp.arcname)
+            return
+        with open(bp.path, "rb", buffering=0) as src, \
+                out.open(self._zipinfo(bp), "w", force_zip64=True) as dst:
+            for chunk in read_chunks(src, self._io_buf):
+                dst.write(chunk)
+
+    @staticmethod
+    def _write_compressed(out, zinfo, data):
+        """Append member with already compressed `data` to the ZipFile `out`.
+        Mirrors what `ZipFile.open(..., mode="w")` does when the member is
+        written and closed, except for the compression.
+        """
+        out.fp.seek(out.start_dir)
+        zinfo.header_offset = out.fp.tell()
+        out._writecheck(zinfo)
+        out._didModify = True
+        out.fp.write(zinfo.FileHeader())
+        out.fp.write(data)
+        out.filelist.append(zinfo)
+        out.NameToInfo[zinfo.filename] = zinfo
+        out.start_dir = out.fp.tell()
+
+    def _write_7z(self, members):
+        """Write the files of the BackupPaths of the iterable `members` to a
+        7z-archive using multi-threaded LZMA2 compression of the external
+        7-Zip executable.
+        The file names are passed by a temporary list file, so the command
+        line length doesn't limit the number of files.
+        Return the size of the archive in bytes.
+        """
+        if shutil.which(SEVENZIP) is None:
+            raise IOError(f"7-Zip executable '{SEVENZIP}' not found. It is "
+                          f"required for compression '{LZMA2_MT}'")
+        level = 9 if self.compresslevel is None else self.compresslevel
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8",
+                                         suffix=".txt",
+                                         delete=False) as listfile:
+            for bp in members:
+                if bp._is_file:
+                    listfile.write(f"{bp.arcname}\n")
+        try:
+            subprocess.run([SEVENZIP, "a", "-t7z", "-m0=lzma2", f"-mx{level}",
+                            f"-mmt{os.cpu_count() or 1}", "-spd", "-scsUTF-8",
+                            self.filename_zip, f"@{listfile.name}"],
+                           cwd=self.root, check=True,
+                           stdout=subprocess.DEVNULL)
+        finally:
+            os.remove(listfile.name)
+        return os.path.getsize(self.filename_zip)
+
 def clean_path(pth, base=os.getcwd(), mode="strict"):
     """If `pth` is relative, combine it with `base`, else take as is.
     `mode` sets the behaviour if the resulting path doesn't exist:
@@ -572,9 +1030,24 @@ def clean_number(x, name, typ=float, mode="strict"):
         if mode == "strict":
             sys.exit(1)
         return None
+
+
+def clean_choice(x, name, choices, mode="strict"):
+    """Return `choices[x]` for a dict of valid choices. `mode` as for
+    `clean_number`
+    """
+    assert mode in ("strict", "ignore", "warn")
+    if x in choices:
+        return choices[x]
+    if mode in ("strict", "warn"):
+        sys.stdout.write(f"\nMust be one of {', '.join(choices)}: {name}={x}")
+    if mode == "strict":
+        sys.exit(1)
+    return None
   
     
-def cmd_build(root, include, exclude, show, filemax, dp):
+def cmd_build(root, include, exclude, show, filemax, dp,
+              follow_symlinks=False):
     """Command line interface function for building the config file.
     See docstring for usage of the parameters.
     """
@@ -586,6 +1059,8 @@ def cmd_build(root, include, exclude, show, filemax, dp):
     if dp > -1:
         sys.stdout.write(f"\n...max. tree depth to display = {dp} (deeper "
                          "files will be considered, but not shown)")
+    if follow_symlinks:
+        sys.stdout.write("\n...symbolically linked directories are followed.")
     if include:
         sys.stdout.write("\n...*Only* these subdirectories will be included:")
         for i in include:
@@ -603,7 +1078,8 @@ def cmd_build(root, include, exclude, show, filemax, dp):
             sys.exit(1)
     
     paths = BackupPathStructure(root, include, exclude,
-                                show*1E6, filemax*1E6, dp, dir_first=True)
+                                show*1E6, filemax*1E6, dp, dir_first=True,
+                                follow_symlinks=follow_symlinks)
     
     paths.make_backup_conf()
     sys.stdout.write(f"\nConfig file written to {get_filename_backupy(root)}")
@@ -620,11 +1096,13 @@ def cmd_reset(root):
         sys.stdout.write(f"\nBackup configuration doesn't exist: {fn}")
 
 
-def cmd_zip(root):
+def cmd_zip(root, compression=ZIP_DEFLATED, level=None,
+            follow_symlinks=False):
     """Command line interface function for creating the zip archive
     from the config file.
     """    
-    paths = BackupPathStructure.from_backup_conf(root)
+    paths = BackupPathStructure.from_backup_conf(
+        root, follow_symlinks=follow_symlinks or None)
     fn = get_filename_backupy(root)
     sys.stdout.write(f"Creating zip file for \"{root}\"")
     if not os.path.exists(fn):
@@ -632,7 +1110,7 @@ def cmd_zip(root):
                          "exist: {fn}. Run the command 'backupy build' first")
         return
 
-    backup = Backup(paths)
+    backup = Backup(paths, compression, level)
     bp_root = backup.bps.backuppaths[0]
     sz = print_size(bp_root.size, fixedwidth=False)
     sys.stdout.write(f" with a size (uncompressed) of {sz}")
@@ -657,10 +1135,16 @@ if __name__ == "__main__":
     show = clean_number(args['--show'], '--show')
     filemax = clean_number(args['--filemax'], '--filemax')
     dp = clean_number(args['--dp'], '--dp', int)
+    compression = clean_choice(args['--compression'], '--compression',
+                               COMPRESSION_METHODS)
+    level = args['--level']
+    if level is not None:
+        level = clean_number(level, '--level', int)
+    follow_symlinks = args['--follow-symlinks']
     sys.stdout.write("\n")
     if args['build'] is True:
-        cmd_build(root, include, exclude, show, filemax, dp)
+        cmd_build(root, include, exclude, show, filemax, dp, follow_symlinks)
     elif args['reset'] is True:
         cmd_reset(root)
     elif args['zip'] is True:
-        cmd_zip(root)
+        cmd_zip(root, compression, level, follow_symlinks)